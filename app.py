@@ -3,39 +3,59 @@ import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import os
 from datetime import datetime, timedelta
-import json
-from collections import defaultdict
+import orjson
+from collections import defaultdict, Counter
 import time
+import threading
+import tempfile
+from urllib.parse import quote
 from dotenv import load_dotenv
 import random
 import math
+import heapq
 import re
-import glob
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 # NEW: for custom HTML/JS (copy-to-clipboard)
 import streamlit.components.v1 as components
+# Lets worker threads render st.* messages into the current script run
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 #for cover upload PNG support 
 import base64
 from io import BytesIO
 from PIL import Image
 
+# Columnar on-disk playlist cache
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 # Load environment variables
 load_dotenv()
 
 # ----------------- SMALL UTILS FROM app.py -----------------
-def clean_spotify_cache():
-    """Delete any existing .cache-* files to force fresh Spotify login"""
-    cache_files = glob.glob(".cache-*")
-    for f in cache_files:
-        try:
-            os.remove(f)
-            print(f"Deleted old cache file: {f}")
-        except Exception as e:
-            print(f"Failed to delete {f}: {e}")
+def clean_spotify_cache(max_age_seconds=3600):
+    """Delete stale .cache-* files (older than max_age_seconds) to force fresh Spotify login"""
+    now = time.time()
+    with os.scandir(".") as entries:
+        for entry in entries:
+            if not entry.name.startswith(".cache-"):
+                continue
+            f = entry.name
+            try:
+                # Leave recent files alone: they belong to visitors who are still logging in
+                if now - entry.stat().st_mtime <= max_age_seconds:
+                    continue
+                os.remove(f)
+                print(f"Deleted old cache file: {f}")
+            except Exception as e:
+                print(f"Failed to delete {f}: {e}")
 
-# Call this early in your app, before Spotify OAuth
-clean_spotify_cache()
+# Call this early in your app, before Spotify OAuth - once per session, not on every rerun
+if not st.session_state.get('_cache_cleaned'):
+    clean_spotify_cache()
+    st.session_state['_cache_cleaned'] = True
 
 # Page config 
 st.set_page_config(
@@ -99,13 +119,7 @@ input[type="radio"] {
 """, unsafe_allow_html=True)
 
 
-def get_logo_base64():
-    with open("crowdsync.png", "rb") as f:
-        return base64.b64encode(f.read()).decode()
-
-logo_base64 = get_logo_base64()
-
-
+@st.cache_resource
 def get_logo_base64():
     with open("crowdsync.png", "rb") as f:
         return base64.b64encode(f.read()).decode()
@@ -137,61 +151,119 @@ st.markdown(
 
 # ==================== CONFIGURATION ====================
 # Cache file paths
-PLAYLIST_CACHE_FILE = "playlist_cache.json"
+PLAYLIST_CACHE_DIR = "playlist_cache"
 GENRE_CACHE_FILE = "genre_cache.json"
 
 # Spotify API setup - 
 SCOPE = "ugc-image-upload playlist-modify-public playlist-modify-private user-library-read"
 
+# Only the track fields we read; the next link keeps the projection for later pages
+PLAYLIST_ITEM_FIELDS = (
+    "items(track(id,name,popularity,explicit,artists(id,name),"
+    "album(release_date),external_urls,available_markets)),next"
+)
+
+# Concurrent artist lookups (Spotify rate limits per app, not per connection)
+ARTIST_FETCH_WORKERS = 6
+GUEST_FETCH_WORKERS = 8
+PLAYLIST_ADD_WORKERS = 4
+ARTIST_FETCH_MAX_RETRIES = 3
+# Longest Retry-After (seconds) we will block the scan for; longer waits give up on the batch
+ARTIST_FETCH_MAX_RETRY_WAIT = 10
+
 # ==================== CACHE MANAGEMENT ====================
+@st.cache_resource
+def _get_cache_lock(filename):
+    """Process-wide lock guarding a cache file and its in-memory copy"""
+    return threading.Lock()
+
+@st.cache_resource(show_spinner=False)
 def load_cache(filename):
-    """Load cache from JSON file"""
+    """Load cache from JSON file once per process; callers share the returned dict"""
     try:
-        with open(filename, 'r') as f:
-            return json.load(f)
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
     except:
         return {}
 
-def save_cache(filename, data):
-    """Save cache to JSON file"""
-    with open(filename, 'w') as f:
-        json.dump(data, f)
+def replace_file_atomically(path, write):
+    """Call write(tmp_path) on a unique temp file next to path, then swap it into place"""
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_cache(filename, entries):
+    """Merge entries into the shared in-memory cache and save it to JSON file"""
+    cache = load_cache(filename)
+    with _get_cache_lock(filename):
+        cache.update(entries)
+        data = orjson.dumps(cache)
+        
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        
+        # Never truncate the live file: other processes (or a crash) would see a partial cache
+        replace_file_atomically(filename, write)
 
-def get_cached_playlists(user_id):
-    """Get cached playlist data if still valid (24 hours)"""
-    cache = load_cache(PLAYLIST_CACHE_FILE)
-    if user_id in cache:
-        cached_time = datetime.fromisoformat(cache[user_id]['timestamp'])
-        if datetime.now() - cached_time < timedelta(hours=24):
-            return cache[user_id]['data']
-    return None
+def get_playlist_cache_path(user_id):
+    """Parquet file holding a user's cached tracks (user id percent-encoded into a safe, unique filename)"""
+    return os.path.join(PLAYLIST_CACHE_DIR, f"{quote(user_id, safe='')}.parquet")
 
-def cache_playlists(user_id, data):
-    """Cache playlist data"""
-    cache = load_cache(PLAYLIST_CACHE_FILE)
-    cache[user_id] = {
-        'timestamp': datetime.now().isoformat(),
-        'data': data
-    }
-    save_cache(PLAYLIST_CACHE_FILE, cache)
+def get_playlists_signature(playlists):
+    """Identify a user's public playlists and their versions (Spotify snapshot ids)"""
+    return "|".join(sorted(f"{p['id']}:{p.get('snapshot_id', '')}" for p in playlists))
 
-def get_cached_genres(artist_id):
-    """Get cached artist genres if still valid (30 days)"""
-    cache = load_cache(GENRE_CACHE_FILE)
-    if artist_id in cache:
-        cached_time = datetime.fromisoformat(cache[artist_id]['timestamp'])
-        if datetime.now() - cached_time < timedelta(days=30):
-            return cache[artist_id]['genres']
+def get_cached_playlists(user_id, signature):
+    """Get cached playlist data if still valid (24 hours, based on file mtime) and the playlists are unchanged"""
+    path = get_playlist_cache_path(user_id)
+    try:
+        cached_time = datetime.fromtimestamp(os.path.getmtime(path))
+        if datetime.now() - cached_time < timedelta(hours=24):
+            table = pq.read_table(path)
+            if (table.schema.metadata or {}).get(b'signature') == signature.encode():
+                return table.to_pylist()
+    except:
+        pass
     return None
 
-def cache_genres(artist_id, genres):
-    """Cache artist genres"""
+def cache_playlists(user_id, data, signature):
+    """Cache playlist data as Parquet, tagged with the playlists signature"""
+    os.makedirs(PLAYLIST_CACHE_DIR, exist_ok=True)
+    path = get_playlist_cache_path(user_id)
+    table = pa.Table.from_pylist(data).replace_schema_metadata({'signature': signature})
+    # Write aside and swap in so concurrent sessions never read a half-written file
+    replace_file_atomically(path, lambda tmp_path: pq.write_table(table, tmp_path))
+
+def get_cached_genres(artist_ids):
+    """Get cached genres for the given artists that are still valid (30 days)"""
     cache = load_cache(GENRE_CACHE_FILE)
-    cache[artist_id] = {
-        'timestamp': datetime.now().isoformat(),
-        'genres': genres
-    }
-    save_cache(GENRE_CACHE_FILE, cache)
+    cutoff = datetime.now() - timedelta(days=30)
+    cached = {}
+    for artist_id in artist_ids:
+        entry = cache.get(artist_id)
+        if entry and datetime.fromisoformat(entry['timestamp']) > cutoff:
+            cached[artist_id] = tuple(entry['genres'])
+    return cached
+
+def cache_genres(genres_by_artist):
+    """Cache a batch of artist genres with a single write of the cache file"""
+    if not genres_by_artist:
+        return
+    timestamp = datetime.now().isoformat()
+    save_cache(GENRE_CACHE_FILE, {
+        artist_id: {'timestamp': timestamp, 'genres': list(genres)}
+        for artist_id, genres in genres_by_artist.items()
+    })
 
 # ==================== SPOTIFY AUTHENTICATION (from app.py) ====================
 def ensure_spotify_authenticated():
@@ -297,17 +369,25 @@ def validate_user_exists(sp, username):
     except Exception as e:
         return False, None
 
-def get_genre_recommendations(all_tracks, guests):
-    """New genre recommendation system with Consensus and Discovery logic"""
+def get_tracks_key(all_tracks):
+    """Cheap content key for a scan's tracks (including their genres), used to memoize per-scan results"""
+    return hash(tuple((t['user_id'], t['id'], t['genre_set']) for t in all_tracks))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_genre_recommendations(tracks_key, _all_tracks, guests):
+    """
+    New genre recommendation system with Consensus and Discovery logic.
+    Memoized on tracks_key + guests; _all_tracks is not hashed by Streamlit.
+    """
+    all_tracks = _all_tracks
     
-    user_genres = defaultdict(lambda: defaultdict(int))
+    user_genres = defaultdict(Counter)
     user_total_tracks = defaultdict(int)
     
     for track in all_tracks:
         user = track['user_id']
         user_total_tracks[user] += 1
-        for genre in track.get('genres', []):
-            user_genres[user][genre] += 1
+        user_genres[user].update(track['genre_set'])
     
     user_genre_proportions = {}
     for user in user_genres:
@@ -399,9 +479,15 @@ def get_genre_recommendations(all_tracks, guests):
     for user_genre_dict in user_genres.values():
         all_genres.update(user_genre_dict.keys())
     
+    # Guests holding each genre (in guest order), shared by the consensus and discovery passes
+    genre_users = defaultdict(list)
+    for u in guests:
+        for genre in user_genres[u]:
+            genre_users[genre].append(u)
+    
     consensus_scores = []
     for genre in all_genres:
-        users_with_genre = [u for u in guests if user_genres[u].get(genre, 0) > 0]
+        users_with_genre = genre_users.get(genre, [])
         num_users_with_genre = len(users_with_genre)
         
         if num_users_with_genre < min_users_required:
@@ -423,7 +509,7 @@ def get_genre_recommendations(all_tracks, guests):
         if genre in consensus_genres:
             continue
         
-        users_with_genre = [u for u in guests if user_genres[u].get(genre, 0) > 0]
+        users_with_genre = genre_users.get(genre, [])
         num_users_with_genre = len(users_with_genre)
         
         if num_users_with_genre == 0 or num_users_with_genre > max_users_for_discovery:
@@ -461,10 +547,65 @@ def get_genre_recommendations(all_tracks, guests):
     
     return consensus, discovery, discovery_message
 
-def get_user_playlists_data(sp, username, market):
-    """Gather all tracks from user's public playlists - NO CACHING"""
+def fetch_playlist_items(sp, playlist_id, username):
+    """
+    Fetch every item of a playlist, following pagination until done or rate limited.
+    Returns (items, complete); complete is False if rate limiting cut the paging short.
+    """
+    results = sp.playlist_items(
+        playlist_id,
+        fields=PLAYLIST_ITEM_FIELDS,
+        additional_types=('track',),
+        limit=100
+    )
+    items = results['items']
+    
+    while results.get('next'):
+        try:
+            results = sp.next(results)
+            items.extend(results['items'])
+        except spotipy.SpotifyException as e:
+            if e.http_status == 429:
+                st.warning(f"⏳ Rate limit hit while fetching tracks for {username}. Skipping remaining tracks.")
+                return items, False
+            else:
+                raise
+    
+    return items, True
+
+# Guards claiming a playlist in a scan's shared_playlist_items (held only for the dict update)
+_shared_playlist_items_lock = threading.Lock()
+
+def fetch_shared_playlist_items(sp, playlist_id, username, shared_playlist_items):
+    """
+    fetch_playlist_items, downloading each playlist once across concurrent guest scans:
+    the first worker claims the id with a Future and fetches it, the others wait on that Future.
+    """
+    with _shared_playlist_items_lock:
+        future = shared_playlist_items.get(playlist_id)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            shared_playlist_items[playlist_id] = future
+    
+    if is_owner:
+        try:
+            future.set_result(fetch_playlist_items(sp, playlist_id, username))
+        except Exception as e:
+            future.set_exception(e)
+    
+    return future.result()
+
+def get_user_playlists_data(sp, username, market, shared_playlist_items=None):
+    """
+    Gather all tracks from user's public playlists.
+    shared_playlist_items (playlist id -> Future of raw items) lets concurrent guest scans fetch
+    a playlist followed by several guests only once; tracks are still attributed per guest.
+    Results are cached per user in Parquet and reused while the playlists are unchanged.
+    """
     
     tracks_data = []
+    complete = True
     
     try:
         playlists = []
@@ -478,6 +619,7 @@ def get_user_playlists_data(sp, username, market):
                 except spotipy.SpotifyException as e:
                     if e.http_status == 429:
                         st.warning(f"⏳ Spotify rate limit hit while scanning playlists for {username}. Skipping the rest.")
+                        complete = False
                         break
                     else:
                         raise
@@ -486,23 +628,28 @@ def get_user_playlists_data(sp, username, market):
         
         public_playlists = [p for p in playlists if p and p['public']]
         
+        # Most tracks share a few identical market lists; keep one frozenset per distinct list
+        market_sets = {}
+        
+        signature = get_playlists_signature(public_playlists)
+        cached = get_cached_playlists(username, signature)
+        if cached is not None:
+            for track_info in cached:
+                markets = tuple(track_info['available_markets'] or ())
+                if markets not in market_sets:
+                    market_sets[markets] = frozenset(markets)
+                track_info['available_markets'] = market_sets[markets]
+            return cached
+        
         for playlist in public_playlists:
             if not playlist:
                 continue
                 
-            results = sp.playlist_tracks(playlist['id'])
-            tracks = results['items']
-            
-            while results.get('next'):
-                try:
-                    results = sp.next(results)
-                    tracks.extend(results['items'])
-                except spotipy.SpotifyException as e:
-                    if e.http_status == 429:
-                        st.warning(f"⏳ Rate limit hit while fetching tracks for {username}. Skipping remaining tracks.")
-                        break
-                    else:
-                        raise
+            if shared_playlist_items is None:
+                tracks, fetched_all = fetch_playlist_items(sp, playlist['id'], username)
+            else:
+                tracks, fetched_all = fetch_shared_playlist_items(sp, playlist['id'], username, shared_playlist_items)
+            complete = complete and fetched_all
                 
             for item in tracks:
                 if not item or not item['track']:
@@ -513,52 +660,103 @@ def get_user_playlists_data(sp, username, market):
                 if not track or not track['id']:
                     continue
                 
+                markets = tuple(track.get('available_markets') or ())
+                if markets not in market_sets:
+                    market_sets[markets] = frozenset(markets)
+                
                 track_info = {
                     'id': track['id'],
                     'name': track['name'],
                     'artists': [a['name'] for a in track['artists']],
                     'artist_ids': [a['id'] for a in track['artists']],
+                    'artist_key': '\x00'.join(sorted(a['id'] for a in track['artists'])),
                     'popularity': track['popularity'],
                     'explicit': track['explicit'],
                     'album_release_date': track['album']['release_date'],
+                    'release_year': parse_release_year(track['album']['release_date']),
                     'url': track['external_urls']['spotify'],
-                    'available_markets': track.get('available_markets', []),
+                    'available_markets': market_sets[markets],
                     'user_id': username,
                     'playlist_name': playlist['name']
                 }
                 
                 tracks_data.append(track_info)
         
+        # Don't pin a rate-limited partial scan (or an empty one) for a day
+        if complete and tracks_data:
+            try:
+                cache_playlists(username, [
+                    {**t, 'available_markets': sorted(t['available_markets'])} for t in tracks_data
+                ], signature)
+            except Exception as e:
+                print(f"Failed to cache playlists for {username}: {e}")
+        
         return tracks_data
     
     except Exception as e:
         st.error(f"Error fetching playlists for {username}: {str(e)}")
         return []
 
-def get_all_genres_from_tracks(tracks):
-    """Extract all unique genres from track data"""
-    all_genres = set()
-    for track in tracks:
-        if 'genres' in track:
-            all_genres.update(track['genres'])
-    return sorted(list(all_genres))
+def get_guest_genre_sets(all_tracks):
+    """Union of each guest's track genres, computed once per scan"""
+    guest_genres = defaultdict(set)
+    for track in all_tracks:
+        guest_genres[track['user_id']].update(track['genre_set'])
+    return {user: frozenset(genres) for user, genres in guest_genres.items()}
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_all_genres_from_tracks(tracks_key, _tracks):
+    """Extract all unique genres from track data (memoized on tracks_key: scan version + content hash)"""
+    return sorted(set().union(*(track['genre_set'] for track in _tracks)))
+
+def parse_retry_after(headers, default=1):
+    """Seconds to wait from a Retry-After header; default if missing or not a number"""
+    try:
+        return max(float((headers or {}).get('Retry-After', default)), 0)
+    except (TypeError, ValueError):
+        return default
 
 def get_artist_genres(sp, artist_ids):
-    """Fetch genres for multiple artists - NO CACHING"""
-    genres_map = {}
-    
-    for i in range(0, len(artist_ids), 50):
-        batch = artist_ids[i:i+50]
-        try:
-            artists_data = sp.artists(batch)
-            for artist in artists_data['artists']:
-                if artist:
-                    genres = artist.get('genres', [])
-                    genres_map[artist['id']] = genres
-            time.sleep(0.1)
-        except Exception as e:
-            st.warning(f"Error fetching artist genres: {str(e)}")
+    """Fetch genres for multiple artists in concurrent 50-artist batches, using the genre cache"""
+    genres_map = get_cached_genres(artist_ids)
+    to_fetch = [a for a in artist_ids if a not in genres_map]
+    batches = [to_fetch[i:i+50] for i in range(0, len(to_fetch), 50)]
+    if not batches:
+        return genres_map
+
+    fetched = {}
+
+    with ThreadPoolExecutor(max_workers=ARTIST_FETCH_WORKERS) as executor:
+        pending = {executor.submit(sp.artists, batch): (batch, 0) for batch in batches}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, attempts = pending.pop(future)
+                try:
+                    artists_data = future.result()
+                except spotipy.SpotifyException as e:
+                    # Rate limited: wait as instructed by Spotify (if reasonable), then resubmit the batch
+                    retry_after = parse_retry_after(e.headers) if e.http_status == 429 else None
+                    if retry_after is not None and retry_after <= ARTIST_FETCH_MAX_RETRY_WAIT and attempts < ARTIST_FETCH_MAX_RETRIES:
+                        time.sleep(retry_after)
+                        pending[executor.submit(sp.artists, batch)] = (batch, attempts + 1)
+                    else:
+                        st.warning(f"Error fetching artist genres: {str(e)}")
+                    continue
+                except Exception as e:
+                    st.warning(f"Error fetching artist genres: {str(e)}")
+                    continue
+
+                for artist in artists_data['artists']:
+                    if artist:
+                        fetched[artist['id']] = tuple(artist.get('genres') or ())
     
+    try:
+        cache_genres(fetched)
+    except Exception as e:
+        print(f"Failed to cache artist genres: {e}")
+    genres_map.update(fetched)
     return genres_map
 
 def parse_release_year(release_date):
@@ -568,382 +766,333 @@ def parse_release_year(release_date):
     except:
         return None
 
+def genre_bloom(genres):
+    """64-bit fingerprint of a genre set; a zero AND with another fingerprint means no overlap"""
+    bloom = 0
+    for g in genres:
+        bloom |= 1 << (hash(g) & 63)
+    return bloom
+
 def filter_tracks(tracks, selected_genres, year_range, popularity_range, market, market_filter_enabled, max_per_artist):
-    """Apply all filters to tracks"""
+    """
+    Apply all filters to tracks.
+    Each enabled filter is one comprehension over the survivors of the previous one
+    (disabled filters cost nothing); the order-dependent per-artist cap runs last.
+    Kept in plain Python rather than NumPy masks: a scan is a few thousand tracks and
+    the result must be track dicts again, so building columns would cost about as much as filtering.
+    """
+    candidates = tracks
+    
+    if selected_genres:
+        selected_set = frozenset(selected_genres)
+        selected_bloom = genre_bloom(selected_set)
+        candidates = [
+            t for t in candidates
+            if t['genre_bloom'] & selected_bloom and not selected_set.isdisjoint(t['genre_set'])
+        ]
+    
+    if year_range:
+        year_from, year_to = year_range
+        candidates = [
+            t for t in candidates
+            if (year := t['release_year']) is not None and year_from <= year <= year_to
+        ]
+    
+    # Spotify popularity is always 0-100, so the "All" range is a no-op pass
+    if popularity_range and tuple(popularity_range) != (0, 100):
+        pop_from, pop_to = popularity_range
+        candidates = [t for t in candidates if pop_from <= t['popularity'] <= pop_to]
+    
+    if market_filter_enabled and market:
+        candidates = [t for t in candidates if market in t['available_markets']]
+    
     filtered = []
-    artist_count = defaultdict(int)
+    artist_count = {}
     
-    for track in tracks:
-        track_genres = track.get('genres', [])
-        if selected_genres and not any(g in track_genres for g in selected_genres):
-            continue
-        
-        release_year = parse_release_year(track['album_release_date'])
-        if year_range:
-            if release_year is None:
-                continue
-            if not (year_range[0] <= release_year <= year_range[1]):
-                continue
-        
-        if popularity_range:
-            pop = track['popularity']
-            if not (popularity_range[0] <= pop <= popularity_range[1]):
-                continue
-        
-        if market_filter_enabled and market:
-            if market not in track.get('available_markets', []):
-                continue
-        
-        artist_key = tuple(sorted(track['artist_ids']))
-        if max_per_artist and artist_count[artist_key] >= max_per_artist:
+    for track in candidates:
+        artist_key = track['artist_key']
+        count = artist_count.get(artist_key, 0)
+        if max_per_artist and count >= max_per_artist:
             continue
         
-        artist_count[artist_key] += 1
+        artist_count[artist_key] = count + 1
         filtered.append(track)
     
     return filtered
 
-def allocate_tracks(tracks, allocation_mode, num_tracks, user_weights=None, selected_genres=None):
+def _equal_user_targets(users, num_tracks):
+    """Split num_tracks evenly across users; the first users absorb the remainder"""
+    user_targets = {u: 0 for u in users}
+    if users:
+        base = num_tracks // len(users)
+        remainder = num_tracks % len(users)
+        for u in users:
+            user_targets[u] = base
+        for u in users[:remainder]:
+            user_targets[u] += 1
+    return user_targets
+
+def _weighted_user_targets(users, num_tracks, user_weights):
+    """
+    Split num_tracks proportionally to user_weights (largest-remainder rounding).
+    Returns None if no user has a positive weight.
     """
-    NEW allocation logic:
+    weights = {u: max(0.0, float(user_weights.get(u, 0))) for u in users}
+    total_w = sum(weights.values())
+    if total_w <= 0:
+        return None
+
+    user_targets = {}
+    assigned = 0
+    fractional = []
+    for u in users:
+        exact = num_tracks * (weights[u] / total_w)
+        base = int(exact)
+        user_targets[u] = base
+        assigned += base
+        fractional.append((exact - base, u))
+    leftover = num_tracks - assigned
+    fractional.sort(reverse=True)
+    for _, u in fractional[:leftover]:
+        user_targets[u] += 1
+    return user_targets
+
+def _primary_genre(track, genre_list):
+    """First genre of genre_list the track belongs to (set lookups on genre_set), or None"""
+    genre_set = track['genre_set']
+    for g in genre_list:
+        if g in genre_set:
+            return g
+    return None
 
-    ✔ Multi-genre: 
+def _fill_from_pool(pool, selected_tracks, used_ids, user_contrib, num_tracks):
+    """
+    Global fill shared by every allocation path: draw random tracks from pool
+    (which must not contain ids already in used_ids) until selected_tracks holds
+    num_tracks. user_contrib is a Counter. Returns the newly added tracks.
+    """
+    # Pre-sized output with a cursor; never overshoots num_tracks by construction
+    need = max(0, min(num_tracks - len(selected_tracks), len(pool)))
+    added = [None] * need
+    cursor = 0
+    while cursor < need and pool:
+        # random.sample only draws the k tracks still needed instead of shuffling the whole pool;
+        # keying by id drops a track drawn twice because several users share it
+        picks = {t["id"]: t for t in random.sample(pool, min(need - cursor, len(pool)))}
+        chunk = list(picks.values())
+
+        added[cursor:cursor + len(chunk)] = chunk
+        cursor += len(chunk)
+        used_ids.update(picks)
+        user_contrib.update(t["user_id"] for t in chunk)
+
+        if cursor < need:
+            pool = [t for t in pool if t["id"] not in used_ids]
+
+    del added[cursor:]
+    selected_tracks.extend(added)
+    return added
+
+def _allocate_multi_equal(tracks, num_tracks, genre_list, user_weights=None):
+    users = sorted({t["user_id"] for t in tracks})
+    user_targets = _equal_user_targets(users, num_tracks)
+    return _allocate_multi_genre(tracks, users, user_targets, num_tracks, genre_list)
+
+def _allocate_multi_focus(tracks, num_tracks, genre_list, user_weights):
+    users = sorted({t["user_id"] for t in tracks})
+    user_targets = _weighted_user_targets(users, num_tracks, user_weights)
+    if user_targets is None:
+        return _allocate_multi_equal(tracks, num_tracks, genre_list)
+    return _allocate_multi_genre(tracks, users, user_targets, num_tracks, genre_list)
+
+def _allocate_multi_genre(tracks, users, user_targets, num_tracks, genre_list):
+    """
+    Multi-genre allocation:
         - User fairness = highest priority
         - Each user gets (target_per_user / #genres) per genre (rounded)
-        - If a user lacks a genre: their quota goes into a global genre pool
-        - Pool tracks get redistributed fairly to users who have the genre
-        - Users without ANY selected genre contribute 0.
-
-    ✔ Single-genre:
-        - Fixes the bug where fewer tracks than requested (e.g., 33/40) were produced
-        - Phase 1: give each user their target tracks (equal or weighted)
-        - Phase 2: ALWAYS fill to exact num_tracks using remaining valid tracks
-        - Now also returns correct genre_contribution for 1 selected genre.
+        - Missing genre quota is filled from the user's other buckets, then globally
     """
-
-    import random
-    from collections import defaultdict
-
-    if not tracks:
-        return [], {"user_contribution": {}, "warnings": []}, {}
-
-    # Determine selected genres
-    if selected_genres:
-        genre_list = list(selected_genres)
-    else:
-        # Auto-detect all genres if none selected
-        all_g = set()
-        for t in tracks:
-            for g in t.get("genres", []):
-                all_g.add(g)
-        genre_list = sorted(all_g)
-
-    multi_genre = len(genre_list) > 1
-
     # ----------------------- GROUP TRACKS BY USER & GENRE -----------------------
     user_genre_tracks = defaultdict(lambda: defaultdict(list))
     user_other_tracks = defaultdict(list)
-    users_set = set()
 
     for track in tracks:
         u = track["user_id"]
-        users_set.add(u)
-
-        genres = track.get("genres", []) or []
-        present = [g for g in genre_list if g in genres]
 
         # assign track to a primary genre bucket if possible
-        if multi_genre and present:
-            primary = present[0]
+        primary = _primary_genre(track, genre_list)
+        if primary is not None:
             user_genre_tracks[u][primary].append(track)
         else:
             user_other_tracks[u].append(track)
 
-    users = sorted(list(users_set))
-
-    # ----------------------- DETERMINE USER TARGETS -----------------------
-    user_targets = {u: 0 for u in users}
-
-    if allocation_mode == "Focus" and user_weights:
-        weights = {u: max(0.0, float(user_weights.get(u, 0))) for u in users}
-        total_w = sum(weights.values())
-        if total_w <= 0:
-            allocation_mode = "Equal"
-        else:
-            assigned = 0
-            fractional = []
-            for u in users:
-                exact = num_tracks * (weights[u] / total_w)
-                base = int(exact)
-                user_targets[u] = base
-                assigned += base
-                fractional.append((exact - base, u))
-            leftover = num_tracks - assigned
-            fractional.sort(reverse=True)
-            for _, u in fractional[:leftover]:
-                user_targets[u] += 1
-
-    if allocation_mode == "Equal":
-        if len(users) > 0:
-            base = num_tracks // len(users)
-            remainder = num_tracks % len(users)
-            for u in users:
-                user_targets[u] = base
-            for u in users[:remainder]:
-                user_targets[u] += 1
-
-    # ----------------------- MULTI-GENRE LOGIC -----------------------
     selected_tracks = []
     used_ids = set()
-    user_contrib = {u: 0 for u in users}
+    user_contrib = Counter(dict.fromkeys(users, 0))
     genre_contrib = defaultdict(int)
+    G = len(genre_list)
 
-    if multi_genre:
-        G = len(genre_list)
-
-        # -------- PER-USER GENRE DISTRIBUTION --------
-        for u in users:
-            target = user_targets[u]
-            if target <= 0:
-                continue
-
-            # total tracks user has in selected genres
-            available = sum(len(user_genre_tracks[u][g]) for g in genre_list)
-            available += len(user_other_tracks[u])
-
-            effective_target = min(target, available)
-            if effective_target <= 0:
-                continue
+    # -------- PER-USER GENRE DISTRIBUTION --------
+    for u in users:
+        target = user_targets[u]
+        if target <= 0:
+            continue
 
-            base_pg = effective_target // G
-            rem_pg = effective_target % G
+        # total tracks user has in selected genres
+        available = sum(len(user_genre_tracks[u][g]) for g in genre_list)
+        available += len(user_other_tracks[u])
 
-            desired_pg = {g: base_pg for g in genre_list}
-            for g in genre_list[:rem_pg]:
-                desired_pg[g] += 1
+        effective_target = min(target, available)
+        if effective_target <= 0:
+            continue
 
-            # ----- Try satisfying each genre quota -----
-            for g in genre_list:
-                need = desired_pg[g]
-                bucket = user_genre_tracks[u][g]
-                while need > 0 and bucket:
-                    t = bucket.pop()
-                    if t["id"] in used_ids:
-                        continue
-                    selected_tracks.append(t)
-                    used_ids.add(t["id"])
-                    user_contrib[u] += 1
-                    genre_contrib[g] += 1
-                    need -= 1
+        base_pg = effective_target // G
+        rem_pg = effective_target % G
 
-            remaining = effective_target - user_contrib[u]
+        desired_pg = {g: base_pg for g in genre_list}
+        for g in genre_list[:rem_pg]:
+            desired_pg[g] += 1
 
-            # Fill remaining from any genre bucket
-            for g in genre_list:
-                if remaining <= 0:
-                    break
-                bucket = user_genre_tracks[u][g]
-                while remaining > 0 and bucket:
-                    t = bucket.pop()
-                    if t["id"] in used_ids:
-                        continue
-                    selected_tracks.append(t)
-                    used_ids.add(t["id"])
-                    user_contrib[u] += 1
-                    genre_contrib[g] += 1
-                    remaining -= 1
-
-            # Fill remaining from non-genre tracks
-            bucket_other = user_other_tracks[u]
-            while remaining > 0 and bucket_other:
-                t = bucket_other.pop()
+        # ----- Try satisfying each genre quota -----
+        for g in genre_list:
+            need = desired_pg[g]
+            bucket = user_genre_tracks[u][g]
+            while need > 0 and bucket:
+                t = bucket.pop()
                 if t["id"] in used_ids:
                     continue
                 selected_tracks.append(t)
                 used_ids.add(t["id"])
                 user_contrib[u] += 1
-                remaining -= 1
-
-        # ---------- PHASE 2: GLOBAL FILL ----------
-        if len(selected_tracks) < num_tracks:
-            global_pool = []
-            for u in users:
-                for g in genre_list:
-                    global_pool.extend(
-                        [t for t in user_genre_tracks[u][g] if t["id"] not in used_ids]
-                    )
-                global_pool.extend(
-                    [t for t in user_other_tracks[u] if t["id"] not in used_ids]
-                )
+                genre_contrib[g] += 1
+                need -= 1
 
-            random.shuffle(global_pool)
+        remaining = effective_target - user_contrib[u]
 
-            while len(selected_tracks) < num_tracks and global_pool:
-                t = global_pool.pop()
+        # Fill remaining from any genre bucket
+        for g in genre_list:
+            if remaining <= 0:
+                break
+            bucket = user_genre_tracks[u][g]
+            while remaining > 0 and bucket:
+                t = bucket.pop()
                 if t["id"] in used_ids:
                     continue
                 selected_tracks.append(t)
                 used_ids.add(t["id"])
-                user_contrib[t["user_id"]] += 1
-                
-                gs = t.get("genres", []) or []
-                for g in genre_list:
-                    if g in gs:
-                        genre_contrib[g] += 1
-                        break
+                user_contrib[u] += 1
+                genre_contrib[g] += 1
+                remaining -= 1
 
-        warnings = []
-        total_sel = len(selected_tracks)
-        effective_users = [u for u in users if user_contrib[u] > 0]
-        if effective_users:
-            ideal = total_sel / len(effective_users)
-            for u in effective_users:
-                if abs(user_contrib[u] - ideal) >= 2:
-                    warnings.append(
-                        f"**{u}** contributed {user_contrib[u]} tracks (ideal ≈ {ideal:.1f})"
-                    )
+        # Fill remaining from non-genre tracks
+        bucket_other = user_other_tracks[u]
+        while remaining > 0 and bucket_other:
+            t = bucket_other.pop()
+            if t["id"] in used_ids:
+                continue
+            selected_tracks.append(t)
+            used_ids.add(t["id"])
+            user_contrib[u] += 1
+            remaining -= 1
+
+    # ---------- PHASE 2: GLOBAL FILL ----------
+    if len(selected_tracks) < num_tracks:
+        # Flatten the leftover buckets once and filter in a single pass
+        buckets = []
+        for u in users:
+            buckets.extend(user_genre_tracks[u][g] for g in genre_list)
+            buckets.append(user_other_tracks[u])
+        global_pool = [t for t in chain.from_iterable(buckets) if t["id"] not in used_ids]
 
-        allocation_info = {
-            "user_contribution": user_contrib,
-            "warnings": warnings
-        }
+        for t in _fill_from_pool(global_pool, selected_tracks, used_ids, user_contrib, num_tracks):
+            primary = _primary_genre(t, genre_list)
+            if primary is not None:
+                genre_contrib[primary] += 1
 
-        random.shuffle(selected_tracks)
-        if len(selected_tracks) > num_tracks:
-            selected_tracks = selected_tracks[:num_tracks]
+    warnings = []
+    total_sel = len(selected_tracks)
+    effective_users = [u for u in users if user_contrib[u] > 0]
+    if effective_users:
+        ideal = total_sel / len(effective_users)
+        for u in effective_users:
+            if abs(user_contrib[u] - ideal) >= 2:
+                warnings.append(
+                    f"**{u}** contributed {user_contrib[u]} tracks (ideal ≈ {ideal:.1f})"
+                )
 
-        return selected_tracks, allocation_info, dict(genre_contrib)
+    allocation_info = {
+        "user_contribution": user_contrib,
+        "warnings": warnings
+    }
 
-    # ----------------------- SINGLE-GENRE LOGIC (FIXED) -----------------------
+    random.shuffle(selected_tracks)
+    del selected_tracks[num_tracks:]
+
+    return selected_tracks, allocation_info, dict(genre_contrib)
+
+def _shuffled_tracks_by_user(tracks):
     user_tracks = defaultdict(list)
     for t in tracks:
         user_tracks[t["user_id"]].append(t)
 
     for u in user_tracks:
         random.shuffle(user_tracks[u])
-
+    return user_tracks
+
+def _allocate_single_equal(tracks, num_tracks, genre_list, user_weights=None):
+    user_tracks = _shuffled_tracks_by_user(tracks)
+    users = list(user_tracks.keys())
+    user_targets = _equal_user_targets(users, num_tracks)
+    return _allocate_single_genre(user_tracks, users, user_targets, num_tracks, genre_list)
+
+def _allocate_single_focus(tracks, num_tracks, genre_list, user_weights):
+    users = list(dict.fromkeys(t["user_id"] for t in tracks))
+    active = [u for u in users if user_weights.get(u, 0) > 0]
+    user_targets = _weighted_user_targets(active, num_tracks, user_weights)
+    if user_targets is None:
+        return _allocate_single_equal(tracks, num_tracks, genre_list)
+    user_tracks = _shuffled_tracks_by_user(tracks)
+    return _allocate_single_genre(user_tracks, active, user_targets, num_tracks, genre_list)
+
+def _allocate_single_genre(user_tracks, users, user_targets, num_tracks, genre_list):
+    """
+    Single-genre allocation:
+        - Phase 1: give each user in `users` their target tracks
+        - Phase 2: ALWAYS fill to exact num_tracks using their remaining valid tracks
+    """
     used_ids = set()
     selected_tracks = []
-    user_contrib = {u: 0 for u in user_tracks}
+    user_contrib = Counter(dict.fromkeys(user_tracks, 0))
     warnings = []
+    user_idx = {u: 0 for u in user_tracks}
 
-    # EQUAL MODE
-    if allocation_mode == "Equal":
-        users_eq = list(user_tracks.keys())
-        m = len(users_eq)
-        if m > 0:
-            base = num_tracks // m
-            remainder = num_tracks % m
-
-            per_user_targets = {u: base for u in users_eq}
-            for u in users_eq[:remainder]:
-                per_user_targets[u] += 1
-
-            user_idx = {u: 0 for u in users_eq}
-
-            # Phase 1: try hitting per-user targets
-            for u in users_eq:
-                need = per_user_targets[u]
-                bucket = user_tracks[u]
-
-                while need > 0 and user_idx[u] < len(bucket):
-                    t = bucket[user_idx[u]]
-                    user_idx[u] += 1
-                    if t["id"] in used_ids:
-                        continue
-                    selected_tracks.append(t)
-                    used_ids.add(t["id"])
-                    user_contrib[u] += 1
-                    need -= 1
-
-                if need > 0:
-                    warnings.append(
-                        f"**{u}** could only contribute {user_contrib[u]} of {per_user_targets[u]} expected tracks."
-                    )
-
-            # Phase 2: global fill
-            if len(selected_tracks) < num_tracks:
-                pool = []
-                for u in users_eq:
-                    for t in user_tracks[u][user_idx[u]:]:
-                        if t["id"] not in used_ids:
-                            pool.append(t)
-
-                random.shuffle(pool)
+    # Phase 1: try hitting per-user targets
+    for u in users:
+        need = user_targets[u]
+        bucket = user_tracks[u]
 
-                while len(selected_tracks) < num_tracks and pool:
-                    t = pool.pop()
-                    if t["id"] in used_ids:
-                        continue
-                    selected_tracks.append(t)
-                    used_ids.add(t["id"])
-                    user_contrib[t["user_id"]] += 1
-
-    else:
-        # FOCUS MODE
-        if not user_weights:
-            user_weights = {u: 1.0 / len(user_tracks) for u in user_tracks}
-
-        active = [u for u in user_tracks if user_weights.get(u, 0) > 0]
-        total_w = sum(user_weights.get(u, 0) for u in active)
-
-        if total_w <= 0:
-            return allocate_tracks(tracks, "Equal", num_tracks, None, selected_genres)
-
-        user_targets_f = {}
-        assigned = 0
-        fractional = []
-        for u in active:
-            exact = num_tracks * (user_weights[u] / total_w)
-            base = int(exact)
-            user_targets_f[u] = base
-            assigned += base
-            fractional.append((exact - base, u))
-
-        leftover = num_tracks - assigned
-        fractional.sort(reverse=True)
-        for _, u in fractional[:leftover]:
-            user_targets_f[u] += 1
-
-        user_idx = {u: 0 for u in user_tracks}
-
-        # Phase 1
-        for u in active:
-            need = user_targets_f[u]
-            bucket = user_tracks[u]
-
-            while need > 0 and user_idx[u] < len(bucket):
-                t = bucket[user_idx[u]]
-                user_idx[u] += 1
-                if t["id"] in used_ids:
-                    continue
-                selected_tracks.append(t)
-                used_ids.add(t["id"])
-                user_contrib[u] += 1
-                need -= 1
-
-            if need > 0:
-                warnings.append(
-                    f"**{u}** could only contribute {user_contrib[u]} of {user_targets_f[u]} expected."
-                )
+        while need > 0 and user_idx[u] < len(bucket):
+            t = bucket[user_idx[u]]
+            user_idx[u] += 1
+            if t["id"] in used_ids:
+                continue
+            selected_tracks.append(t)
+            used_ids.add(t["id"])
+            user_contrib[u] += 1
+            need -= 1
+
+        if need > 0:
+            warnings.append(
+                f"**{u}** could only contribute {user_contrib[u]} of {user_targets[u]} expected tracks."
+            )
 
-        # Phase 2 global fill
-        if len(selected_tracks) < num_tracks:
-            pool = []
-            for u in active:
-                for t in user_tracks[u][user_idx[u]:]:
-                    if t["id"] not in used_ids:
-                        pool.append(t)
+    # Phase 2: global fill
+    if len(selected_tracks) < num_tracks:
+        # Walk each user's unused tail from their cursor, without copying slices
+        leftovers = chain.from_iterable(islice(user_tracks[u], user_idx[u], None) for u in users)
+        pool = [t for t in leftovers if t["id"] not in used_ids]
 
-            random.shuffle(pool)
-
-            while len(selected_tracks) < num_tracks and pool:
-                t = pool.pop()
-                if t["id"] in used_ids:
-                    continue
-                selected_tracks.append(t)
-                used_ids.add(t["id"])
-                user_contrib[t["user_id"]] += 1
+        _fill_from_pool(pool, selected_tracks, used_ids, user_contrib, num_tracks)
 
     allocation_info = {
         "user_contribution": user_contrib,
@@ -951,56 +1100,90 @@ def allocate_tracks(tracks, allocation_mode, num_tracks, user_weights=None, sele
     }
 
     random.shuffle(selected_tracks)
+    del selected_tracks[num_tracks:]
 
-    if len(selected_tracks) > num_tracks:
-        selected_tracks = selected_tracks[:num_tracks]
+    # Genre contribution for the (at most one) selected genre
+    genre_contrib = Counter(_primary_genre(t, genre_list) for t in selected_tracks)
+    genre_contrib.pop(None, None)
 
-    # ✅ NEW: compute genre_contribution for single-genre case too
-    genre_contrib = defaultdict(int)
-    genres_for_count = selected_genres if selected_genres else genre_list
+    return selected_tracks, allocation_info, dict(genre_contrib)
 
-    for t in selected_tracks:
-        track_genres = t.get("genres", []) or []
-        for g in genres_for_count:
-            if g in track_genres:
-                genre_contrib[g] += 1
-                break
+def allocate_tracks(tracks, allocation_mode, num_tracks, user_weights=None, selected_genres=None):
+    """
+    NEW allocation logic, dispatched to a specialized path per case:
 
-    return selected_tracks, allocation_info, dict(genre_contrib)
+    ✔ Multi-genre (_allocate_multi_equal / _allocate_multi_focus):
+        - User fairness = highest priority
+        - Each user gets (target_per_user / #genres) per genre (rounded)
+        - If a user lacks a genre: their quota goes into a global genre pool
+        - Pool tracks get redistributed fairly to users who have the genre
+        - Users without ANY selected genre contribute 0.
+
+    ✔ Single-genre (_allocate_single_equal / _allocate_single_focus):
+        - Fixes the bug where fewer tracks than requested (e.g., 33/40) were produced
+        - Phase 1: give each user their target tracks (equal or weighted)
+        - Phase 2: ALWAYS fill to exact num_tracks using remaining valid tracks
+        - Now also returns correct genre_contribution for 1 selected genre.
+
+    Focus mode without any positive weight falls back to Equal.
+    """
+    if not tracks:
+        return [], {"user_contribution": {}, "warnings": []}, {}
+
+    # Determine selected genres
+    if selected_genres:
+        genre_list = list(selected_genres)
+    else:
+        # Auto-detect all genres if none selected
+        all_g = set()
+        for t in tracks:
+            for g in t.get("genres", []):
+                all_g.add(g)
+        genre_list = sorted(all_g)
+
+    focus = allocation_mode == "Focus" and bool(user_weights)
+    if len(genre_list) > 1:
+        allocate = _allocate_multi_focus if focus else _allocate_multi_equal
+    else:
+        allocate = _allocate_single_focus if focus else _allocate_single_equal
+
+    return allocate(tracks, num_tracks, genre_list, user_weights)
 
 
 def get_top_consensus_tracks(all_tracks, selected_track_ids, limit=10):
-    """Get top tracks sorted ONLY by number of users"""
-    candidate_tracks = [t for t in all_tracks if t['id'] not in selected_track_ids]
-    
-    track_user_counts = defaultdict(set)
-    for track in candidate_tracks:
-        track_user_counts[track['id']].add(track['user_id'])
+    """Get top tracks sorted ONLY by number of users (single pass over all_tracks)"""
+    first_seen = {}
+    user_pairs = set()
+    for track in all_tracks:
+        track_id = track['id']
+        if track_id in selected_track_ids:
+            continue
+        first_seen.setdefault(track_id, track)
+        user_pairs.add((track_id, track['user_id']))
     
-    consensus_tracks = [t for t in candidate_tracks if len(track_user_counts[t['id']]) >= 2]
+    # Distinct users per track from the (id, user) pairs - no per-track set allocations
+    user_counts = Counter(track_id for track_id, _ in user_pairs)
     
-    seen = set()
     unique_tracks = []
-    for track in consensus_tracks:
-        if track['id'] not in seen:
-            seen.add(track['id'])
-            track['user_count'] = len(track_user_counts[track['id']])
+    for track_id, track in first_seen.items():
+        user_count = user_counts[track_id]
+        if user_count >= 2:
+            track['user_count'] = user_count
             unique_tracks.append(track)
     
-    unique_tracks.sort(key=lambda t: t['user_count'], reverse=True)
-    
-    return unique_tracks[:limit]
+    return heapq.nlargest(limit, unique_tracks, key=lambda t: t['user_count'])
 
-def get_display_name(username):
-    """Get display name for username"""
-    if 'username_to_display_name' in st.session_state:
-        return st.session_state.username_to_display_name.get(username, username)
-    return username
+def encode_jpeg(img, quality):
+    """Single-pass baseline JPEG encode (4:2:0 chroma subsampling) into a BytesIO"""
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, subsampling=2, optimize=False, progressive=False)
+    return buffer
 
 # helper to process any image (upload OR camera) for Spotify
-def process_image_for_spotify(image_bytes):
+def process_image_for_spotify_b64(image_bytes):
     """
-    Resize + convert + compress the image until Spotify accepts it (<256 KB JPEG)
+    Resize + convert + compress the image until Spotify accepts it (<256 KB JPEG).
+    Returns the base64-encoded JPEG ready for upload, or None.
     """
     try:
         img = Image.open(BytesIO(image_bytes))
@@ -1010,21 +1193,33 @@ def process_image_for_spotify(image_bytes):
     # Always convert to JPEG (Spotify requirement)
     img = img.convert("RGB")
 
-    # Resize if very large (phone cameras etc.)
-    max_dimension = 640
+    # Resize if very large (phone cameras etc.) - Spotify shows covers at <= 300px
+    max_dimension = 512
     img.thumbnail((max_dimension, max_dimension))
 
-    # Compress until < 256 KB or quality too low
-    quality = 90
-    while quality >= 10:
-        buffer = BytesIO()
-        img.save(buffer, format="JPEG", quality=quality)
-        data = buffer.getvalue()
-        if len(data) <= 256 * 1024:
-            return data
-        quality -= 5
+    # Common path: one 4:2:0 encode at quality 75 fits comfortably for a 512px cover
+    buffer = encode_jpeg(img, 75)
+    if buffer.tell() <= 256 * 1024:
+        return base64.b64encode(buffer.getbuffer())
+
+    # Fallback: binary search for the highest lower quality (10..70, steps of 5) that fits
+    qualities = list(range(10, 75, 5))
+    lo, hi = 0, len(qualities) - 1
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        buffer = encode_jpeg(img, qualities[mid])
+        if buffer.tell() <= 256 * 1024:
+            best = buffer
+            lo = mid + 1
+        else:
+            hi = mid - 1
+
+    if best is None:
+        return None  # even quality 10 is above 256 KB
 
-    return None  # couldn't get under 256 KB
+    # Encode straight from the buffer's memory, without a getvalue() copy
+    return base64.b64encode(best.getbuffer())
 
 def main():
     # st.title("🎵 CrowdSync - Party Playlist Generator")
@@ -1051,30 +1246,24 @@ def main():
             key="guest_input"
         )
         
-        raw_guests = [g.strip() for g in guest_input.split('\n') if g.strip()]
-        processed_guests = []
-        
-        for guest in raw_guests:
-            if 'spotify.com/user/' in guest or '/user/' in guest:
-                username = extract_username_from_url(guest)
-                if username:
-                    processed_guests.append(username)
-                else:
-                    processed_guests.append(guest)
-            else:
-                processed_guests.append(guest)
-        
-        guests = []
-        seen = set()
+        # Single pass: strip, resolve profile URLs, dedupe case-insensitively (first spelling wins)
+        seen = {}
         duplicates = []
         
-        for guest in processed_guests:
+        for line in guest_input.split('\n'):
+            guest = line.strip()
+            if not guest:
+                continue
+            if '/user/' in guest:
+                guest = extract_username_from_url(guest) or guest
+            
             guest_lower = guest.lower()
             if guest_lower in seen:
                 duplicates.append(guest)
             else:
-                seen.add(guest_lower)
-                guests.append(guest)
+                seen[guest_lower] = guest
+        
+        guests = list(seen.values())
         
         if duplicates:
             st.warning(f"⚠️ Duplicate usernames removed: {', '.join(duplicates)}")
@@ -1153,39 +1342,52 @@ def main():
                 progress_bar = st.progress(0)
                 status_text = st.empty()
                 
+                user_market = current_user.get('country', 'US')
+                tracks_by_guest = {}
+                shared_playlist_items = {}
+                
+                # Scan all guests concurrently; workers share this run's context so their warnings still render
+                ctx = get_script_run_ctx()
+                with ThreadPoolExecutor(max_workers=GUEST_FETCH_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+                    futures = {executor.submit(get_user_playlists_data, sp, guest, user_market, shared_playlist_items): guest for guest in guests}
+                    for idx, future in enumerate(as_completed(futures)):
+                        guest = futures[future]
+                        tracks_by_guest[guest] = future.result()
+                        status_text.text(f"Scanned playlists for {guest}...")
+                        progress_bar.progress((idx + 1) / len(guests))
+                
+                # One genre lookup for the union of artists across all guests
+                status_text.text("Identifying genres...")
+                artist_ids = set()
+                for tracks in tracks_by_guest.values():
+                    for track in tracks:
+                        artist_ids.update(track['artist_ids'])
+                
+                genres_map = get_artist_genres(sp, list(artist_ids))
+                
                 all_tracks = []
                 users_no_playlists = []
                 
-                for idx, guest in enumerate(guests):
-                    status_text.text(f"Processing {guest}...")
-                    
-                    user_market = current_user.get('country', 'US')
-                    tracks = get_user_playlists_data(sp, guest, user_market)
-                    
+                for guest in guests:
+                    tracks = tracks_by_guest[guest]
                     if not tracks:
                         users_no_playlists.append(guest)
-                    else:
-                        artist_ids = set()
-                        for track in tracks:
-                            artist_ids.update(track['artist_ids'])
-                        
-                        genres_map = get_artist_genres(sp, list(artist_ids))
-                        
-                        for track in tracks:
-                            track_genres = []
-                            for artist_id in track['artist_ids']:
-                                track_genres.extend(genres_map.get(artist_id, []))
-                            track['genres'] = list(set(track_genres))
-                        
-                        all_tracks.extend(tracks)
+                        continue
+                    
+                    for track in tracks:
+                        genre_set = frozenset(g for artist_id in track['artist_ids'] for g in genres_map.get(artist_id, ()))
+                        track['genre_set'] = genre_set
+                        track['genre_bloom'] = genre_bloom(genre_set)
+                        track['genres'] = list(genre_set)
                     
-                    progress_bar.progress((idx + 1) / len(guests))
+                    all_tracks.extend(tracks)
                 
                 status_text.empty()
                 progress_bar.empty()
                 
                 if users_no_playlists:
-                    users_no_playlists_display = [get_display_name(u) if u in st.session_state.get('username_to_display_name', {}) else u for u in users_no_playlists]
+                    display_names = st.session_state.get('username_to_display_name', {})
+                    users_no_playlists_display = [display_names.get(u, u) for u in users_no_playlists]
                     st.warning(f"⚠️ No public playlists found for: {', '.join(users_no_playlists_display)}")
                     st.info("💡 **Note:** Users without public playlists cannot contribute their music taste.")
                 
@@ -1194,21 +1396,19 @@ def main():
                     st.stop()
                 
                 st.session_state.all_tracks = all_tracks
+                # Every scan gets a new version, so per-scan memoized results are never reused stale
+                st.session_state.tracks_version = st.session_state.get('tracks_version', 0) + 1
+                st.session_state.tracks_key = (st.session_state.tracks_version, get_tracks_key(all_tracks))
+                st.session_state.guest_genre_sets = get_guest_genre_sets(all_tracks)
                 st.session_state.guests = guests
                 st.session_state.validation_complete = True
                 
                 if 'username_to_display_name' not in st.session_state:
-                    username_to_display_name = {}
-                    for guest in guests:
-                        if 'validated_guests' in st.session_state and guest in st.session_state.validated_guests:
-                            user_data = st.session_state.validated_guests[guest].get('data')
-                            if user_data:
-                                username_to_display_name[guest] = user_data.get('display_name', guest)
-                            else:
-                                username_to_display_name[guest] = guest
-                        else:
-                            username_to_display_name[guest] = guest
-                    st.session_state.username_to_display_name = username_to_display_name
+                    validated = st.session_state.get('validated_guests', {})
+                    st.session_state.username_to_display_name = {
+                        guest: (validated.get(guest, {}).get('data') or {}).get('display_name', guest)
+                        for guest in guests
+                    }
                 
                 st.success(f"✅ Successfully gathered {len(all_tracks)} tracks from {len(guests)} guests!")
                 st.rerun()
@@ -1217,6 +1417,13 @@ def main():
          st.info("👆 Complete Step 1 and validate usernames to continue.")
          st.stop()
 
+        # Resolve display names from one local mapping for the rest of the render pass
+        display_names = st.session_state.get('username_to_display_name', {})
+        if 'tracks_key' not in st.session_state:
+            st.session_state.tracks_key = (st.session_state.get('tracks_version', 0), get_tracks_key(st.session_state.all_tracks))
+        if 'guest_genre_sets' not in st.session_state:
+            st.session_state.guest_genre_sets = get_guest_genre_sets(st.session_state.all_tracks)
+
         st.header("Step 2: Select Genre & Filters")
         
         selected_genres = []
@@ -1225,9 +1432,9 @@ def main():
         max_per_artist = 5
         
         if st.session_state.get('validation_complete', False) and 'all_tracks' in st.session_state:
-            all_genres = get_all_genres_from_tracks(st.session_state.all_tracks)
+            all_genres = get_all_genres_from_tracks(st.session_state.tracks_key, st.session_state.all_tracks)
             total_tracks_found = len(st.session_state.all_tracks)
-            guest_display_names = [get_display_name(g) for g in st.session_state.guests]
+            guest_display_names = [display_names.get(g, g) for g in st.session_state.guests]
             guest_list = ", ".join(guest_display_names)
             
             if all_genres:
@@ -1237,10 +1444,11 @@ def main():
         
         with col3:
             if st.session_state.get('validation_complete', False) and 'all_tracks' in st.session_state:
-                all_genres = get_all_genres_from_tracks(st.session_state.all_tracks)
+                all_genres = get_all_genres_from_tracks(st.session_state.tracks_key, st.session_state.all_tracks)
                 
                 if all_genres:
                     consensus, discovery, discovery_message = get_genre_recommendations(
+                        st.session_state.tracks_key,
                         st.session_state.all_tracks, 
                         st.session_state.guests
                     )
@@ -1259,7 +1467,7 @@ def main():
                             for idx, item in enumerate(discovery, 1):
                                 genre = item[0]
                                 users = item[1]
-                                user_display_names = [get_display_name(u) for u in users]
+                                user_display_names = [display_names.get(u, u) for u in users]
                                 user_list = ", ".join(user_display_names)
                                 st.markdown(f"{idx}. **{genre}** (from {user_list})")
                         elif discovery_message:
@@ -1361,7 +1569,7 @@ def main():
             total_weight = 0
             
             for idx, guest in enumerate(st.session_state.guests):
-                display_name = get_display_name(guest)
+                display_name = display_names.get(guest, guest)
                 default_value = st.session_state.user_weight_values.get(guest, 0)
                 weight = st.slider(
                     f"{display_name}", 
@@ -1435,8 +1643,8 @@ def main():
                     if 'tracks_to_remove' not in st.session_state:
                         st.session_state.tracks_to_remove = set()
                     
-                    selected_ids = {t['id'] for t in selected_tracks}
-                    top_consensus = get_top_consensus_tracks(filtered_tracks, selected_ids)
+                    st.session_state.selected_ids = {t['id'] for t in selected_tracks}
+                    top_consensus = get_top_consensus_tracks(filtered_tracks, st.session_state.selected_ids)
                     st.session_state.top_consensus = top_consensus
                 
                 st.success("✅ Playlist generated successfully!")
@@ -1450,6 +1658,15 @@ def main():
         all_tracks = st.session_state.all_tracks
         allocation_info = st.session_state.get('allocation_info', {})
         
+        # Single pass over the selection, shared by save, refill, track list and consensus
+        if 'tracks_to_remove' not in st.session_state:
+            st.session_state.tracks_to_remove = set()
+        if 'selected_ids' not in st.session_state:
+            st.session_state.selected_ids = {t['id'] for t in selected_tracks}
+        removed_ids = st.session_state.tracks_to_remove
+        kept_tracks = [t for t in selected_tracks if t['id'] not in removed_ids]
+        kept_ids = st.session_state.selected_ids - removed_ids
+        
         genre_display = ", ".join(selected_genres) if selected_genres else "All"
         pop_display = f"{popularity_range[0]}–{popularity_range[1]}"
         year_display = f"{year_range[0]}–{year_range[1]}" if year_range else "All"
@@ -1460,7 +1677,7 @@ def main():
             st.markdown("**Track Contribution by Guest**")
             if 'user_contribution' in allocation_info and allocation_info['user_contribution']:
                 for user, count in allocation_info['user_contribution'].items():
-                    display_name = get_display_name(user)
+                    display_name = display_names.get(user, user)
                     percentage = (count / len(selected_tracks) * 100) if selected_tracks else 0
                     st.markdown(f"**{display_name}**  \n{count} tracks • {percentage:.1f}%")
             else:
@@ -1488,7 +1705,7 @@ def main():
 
             st.markdown('</div>', unsafe_allow_html=True)
             if save_clicked:
-                    final_tracks = [t for t in st.session_state.selected_tracks if t['id'] not in st.session_state.get('tracks_to_remove', set())]
+                    final_tracks = kept_tracks
                     
                     if not final_tracks:
                         st.error("No tracks to save!")
@@ -1508,21 +1725,24 @@ def main():
                                 track_uris = [f"spotify:track:{t['id']}" for t in final_tracks]
                                 skipped = []
                                 
-                                for i in range(0, len(track_uris), 100):
-                                    batch = track_uris[i:i+100]
-                                    try:
-                                        sp.playlist_add_items(playlist['id'], batch)
-                                    except Exception as e:
-                                        skipped.extend(batch)
+                                # Add the 100-track chunks concurrently. Chunks land in completion order,
+                                # which is fine because the track order is already shuffled.
+                                batches = [track_uris[i:i+100] for i in range(0, len(track_uris), 100)]
+                                with ThreadPoolExecutor(max_workers=PLAYLIST_ADD_WORKERS) as executor:
+                                    futures = {executor.submit(sp.playlist_add_items, playlist['id'], batch): batch for batch in batches}
+                                    for future in as_completed(futures):
+                                        try:
+                                            future.result()
+                                        except Exception as e:
+                                            skipped.extend(futures[future])
 
                                 # 🎨 NEW: handle cover upload (upload OR camera) AFTER playlist is created
                                 if final_image_bytes is not None:
                                     try:
-                                        processed_bytes = process_image_for_spotify(final_image_bytes)
-                                        if processed_bytes is None:
+                                        encoded_cover = process_image_for_spotify_b64(final_image_bytes)
+                                        if encoded_cover is None:
                                             st.error("Image could not be reduced below 256 KB. Try a smaller or simpler photo.")
                                         else:
-                                            encoded_cover = base64.b64encode(processed_bytes)
                                             sp.playlist_upload_cover_image(playlist['id'], encoded_cover)
                                             st.success("📸 Custom playlist cover uploaded!")
                                     except Exception as cover_err:
@@ -1551,23 +1771,24 @@ def main():
             with col_refill:
                 if st.session_state.get('tracks_to_remove'):
                     if st.button("🔄 Refill Removed Slots", key="refill_slots_btn"):
-                        permanently_removed = st.session_state.tracks_to_remove.copy()
-                        all_selected_ids = {t['id'] for t in selected_tracks}
+                        selected_ids = st.session_state.selected_ids
                         
                         remaining_tracks = [
                             t for t in filtered_tracks 
-                            if t['id'] not in all_selected_ids and t['id'] not in permanently_removed
+                            if t['id'] not in selected_ids and t['id'] not in removed_ids
                         ]
                         random.shuffle(remaining_tracks)
                         
-                        num_to_add = len(st.session_state.tracks_to_remove)
+                        num_to_add = len(removed_ids)
                         new_tracks = remaining_tracks[:num_to_add]
                         
-                        kept_tracks = [t for t in selected_tracks if t['id'] not in st.session_state.tracks_to_remove]
                         st.session_state.selected_tracks = kept_tracks + new_tracks
+                        selected_ids.difference_update(removed_ids)
+                        selected_ids.update(t['id'] for t in new_tracks)
                         st.session_state.tracks_to_remove = set()
                         
-                        # display order is preserved via track_display_order; no reset needed
+                        # Removed ids already left the display order; new tracks join at the end
+                        st.session_state.track_display_order.extend(t['id'] for t in new_tracks)
                         st.rerun()
         
         with metrics_col2:
@@ -1588,20 +1809,22 @@ def main():
             st.metric("Shortfall", shortfall, delta="Need more tracks" if shortfall > 0 else "Complete")
         
         # ✅ NEW: build allocation notices including guests with no tracks in selected genres
-        all_warnings = allocation_info.get('warnings', []).copy()
+        # Allocation warnings name guests by username; swap in display names once per warning
+        subs = [(f"**{guest}**", f"**{display_names.get(guest, guest)}**") for guest in st.session_state.guests]
+        all_warnings = []
+        for warning in allocation_info.get('warnings', []):
+            for old, new in subs:
+                warning = warning.replace(old, new)
+            all_warnings.append(warning)
 
         if selected_genres:
             # Guests who have NO tracks at all in the selected genres (in their public playlists)
-            users_with_selected_genre = set()
-            for t in all_tracks:
-                if t['user_id'] in st.session_state.guests:
-                    track_genres = t.get('genres', []) or []
-                    if any(g in track_genres for g in selected_genres):
-                        users_with_selected_genre.add(t['user_id'])
+            selected_set = frozenset(selected_genres)
+            guest_genre_sets = st.session_state.guest_genre_sets
             
             for guest in st.session_state.guests:
-                if guest not in users_with_selected_genre:
-                    display_name = get_display_name(guest)
+                if guest_genre_sets.get(guest, frozenset()).isdisjoint(selected_set):
+                    display_name = display_names.get(guest, guest)
                     all_warnings.append(
                         f"**{display_name}** does not contribute any tracks because they have no songs in the selected genres in their public playlists."
                     )
@@ -1609,13 +1832,7 @@ def main():
         if all_warnings:
             st.warning("⚠️ **Allocation Notices:**")
             for warning in all_warnings:
-                updated_warning = warning
-                # Preserve existing display-name replacement for username-based warnings
-                for guest in st.session_state.guests:
-                    display_name = get_display_name(guest)
-                    if f"**{guest}**" in updated_warning:
-                        updated_warning = updated_warning.replace(f"**{guest}**", f"**{display_name}**")
-                st.markdown(f"- {updated_warning}")
+                st.markdown(f"- {warning}")
             st.info("💡 Remaining slots were filled with the best-ranked tracks from users who had available songs.")
         
         st.markdown("---")
@@ -1625,24 +1842,20 @@ def main():
         with bottom_left:
             st.subheader("🎵 Track List")
 
-            if 'tracks_to_remove' not in st.session_state:
-                st.session_state.tracks_to_remove = set()
-
-            # Build current list of tracks (excluding removed ones)
-            display_tracks = [t for t in selected_tracks if t['id'] not in st.session_state.tracks_to_remove]
+            # Current list of tracks (excluding removed ones)
+            display_tracks = kept_tracks
 
             # Ensure we have a persistent display order based on track IDs
             if 'track_display_order' not in st.session_state:
                 st.session_state.track_display_order = [t['id'] for t in selected_tracks]
 
-            order = st.session_state.track_display_order
-            order_index = {tid: i for i, tid in enumerate(order)}
-
-            # Sort tracks by their stored order; new tracks (not in order) go at the end
-            display_tracks_sorted = sorted(
-                display_tracks,
-                key=lambda t: order_index.get(t['id'], len(order) + 1)
-            )
+            # Walk the stored order once; new tracks (not in order) go at the end
+            tracks_by_id = {t['id']: t for t in display_tracks}
+            display_tracks_sorted = [
+                tracks_by_id.pop(tid) for tid in st.session_state.track_display_order
+                if tid in tracks_by_id
+            ]
+            display_tracks_sorted.extend(tracks_by_id.values())
 
             for position, track in enumerate(display_tracks_sorted, start=1):
 
@@ -1650,9 +1863,9 @@ def main():
 
                 with col_track:
                     genres_display = ", ".join(track['genres'][:3]) if track['genres'] else "No genre"
-                    year = parse_release_year(track['album_release_date'])
+                    year = track['release_year']
                     artists_display = ', '.join([a for a in track['artists'] if a]) or "Unknown Artist"
-                    friend_display_name = get_display_name(track['user_id'])
+                    friend_display_name = display_names.get(track['user_id'], track['user_id'])
 
                     st.markdown(f"""
                     **{position}. {track['name']}** by {artists_display}  
@@ -1660,18 +1873,19 @@ def main():
                     """)
 
                 with col_button:
-                    if st.button("🗑️", key=f"remove_{track['id']}_{position}"):
+                    if st.button("🗑️", key=f"remove_{track['id']}"):
                         st.session_state.tracks_to_remove.add(track['id'])
+                        st.session_state.track_display_order = [
+                            tid for tid in st.session_state.track_display_order if tid != track['id']
+                        ]
                         st.rerun()
 
 
         with bottom_right:
             st.subheader("⭐ Top Consensus Songs (Not in the Playlist)")
             
-            current_selected_ids = {t['id'] for t in selected_tracks if t['id'] not in st.session_state.get('tracks_to_remove', set())}
-            
             if 'filtered_tracks' in st.session_state:
-                top_consensus = get_top_consensus_tracks(st.session_state.filtered_tracks, current_selected_ids)
+                top_consensus = get_top_consensus_tracks(st.session_state.filtered_tracks, kept_ids)
                 st.session_state.top_consensus = top_consensus
             
             if st.session_state.get('top_consensus'):
@@ -1682,7 +1896,7 @@ def main():
                     
                     with col_consensus:
                         genres_display = ", ".join(track['genres'][:3]) if track['genres'] else "No genre"
-                        year = parse_release_year(track['album_release_date'])
+                        year = track['release_year']
                         artists_display = ', '.join([a for a in track['artists'] if a]) or "Unknown Artist"
                         user_count = track.get('user_count', 0)
                         
@@ -1693,9 +1907,13 @@ def main():
                     
                     with col_add:
                         if st.button("➕", key=f"add_{track['id']}"):
-                            st.session_state.selected_tracks.append(track)
-                            if 'track_display_order' in st.session_state and track['id'] not in st.session_state.track_display_order:
-                                st.session_state.track_display_order.append(track['id'])
+                            if track['id'] in st.session_state.selected_ids:
+                                # Still selected but pending removal: just restore it
+                                st.session_state.tracks_to_remove.discard(track['id'])
+                            else:
+                                st.session_state.selected_tracks.append(track)
+                                st.session_state.selected_ids.add(track['id'])
+                            st.session_state.track_display_order.append(track['id'])
                             st.rerun()
             else:
                 st.info("No additional consensus tracks found that aren't already in the playlist.")